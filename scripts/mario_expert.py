@@ -10,11 +10,28 @@ import json
 import logging
 import math
 import cv2
+import numpy as np
 
+from collections import deque
 from enum import IntEnum
+from functools import cached_property
+from itertools import repeat, starmap
 from mario_environment import MarioEnvironment
 from pyboy.utils import WindowEvent
 
+try:
+    from numba import njit
+except ImportError:
+    # Numba is optional, fall back to running the helpers as plain Python/NumPy
+    def njit(*args, **kwargs):
+        return lambda func: func
+
+try:
+    from mario_kernel import choose as _kernel_choose
+except ImportError:
+    # The Cython kernel is optional, see setup.py for how to build it
+    _kernel_choose = None
+
 class Sprites(IntEnum):
     AIR = 0
     MARIO = 1
@@ -29,6 +46,23 @@ class Sprites(IntEnum):
     BEE = 19
     SHELL = 25
 
+# Plain int aliases of the sprite ids, used by the scanning helpers to skip Enum lookups
+_AIR = Sprites.AIR.value
+_MARIO = Sprites.MARIO.value
+_BLOCK = Sprites.BLOCK.value
+_BRICK = Sprites.BRICK.value
+_PIPE = Sprites.PIPE.value
+_GOOMBA = Sprites.GOOMBA.value
+
+# Rows and columns of the compressed game area returned by MarioEnvironment.game_area
+_GAME_AREA_SHAPE = (16, 20)
+# Sprite ids all fit in a signed byte, so the game area is kept as int8 (signed char in
+# mario_kernel.pyx) rather than pyboy's wider ints
+_GAME_AREA_DTYPE = np.int8
+# Columns of the region of interest starting at Mario's column. The obstacle, platform and
+# pit checks never look further ahead than this.
+_ROI_WIDTH = 8
+
 class Actions(IntEnum):
     LEFT = 1
     RIGHT = 2
@@ -85,36 +119,168 @@ class MarioController(MarioEnvironment):
         self.valid_actions = valid_actions
         self.release_button = release_button
 
-    def run_action(self, action, duration) -> None:
-        if action == Actions.JUMP:
-            self.pyboy.send_input(self.valid_actions[Actions.RIGHT.value])
-            self.pyboy.send_input(self.valid_actions[Actions.SPRINT.value])
-            self.pyboy.send_input(self.valid_actions[Actions.JUMP.value])
-
-            for _ in range(self.act_freq * duration):
-                self.pyboy.tick()
+        # (press, release) button events for each action, resolved once so run_action
+        # only has to look up its action
+        press = {action: valid_actions[action.value] for action in Actions}
+        release = {action: release_button[action.value] for action in Actions}
+        self.action_events = {action: ((press[action],), (release[action],)) for action in Actions}
+        # Jumping and moving right also hold right and sprint
+        self.action_events[Actions.JUMP] = (
+            (press[Actions.RIGHT], press[Actions.SPRINT], press[Actions.JUMP]),
+            (release[Actions.JUMP], release[Actions.SPRINT], release[Actions.RIGHT]),
+        )
+        self.action_events[Actions.RIGHT] = (
+            (press[Actions.RIGHT], press[Actions.SPRINT]),
+            (release[Actions.SPRINT], release[Actions.RIGHT]),
+        )
 
-            self.pyboy.send_input(self.release_button[Actions.JUMP.value])
-            self.pyboy.send_input(self.release_button[Actions.SPRINT.value])
-            self.pyboy.send_input(self.release_button[Actions.RIGHT.value])
+    # Advance the emulator act_freq * duration frames, with the loop driven from C by starmap
+    def run_ticks(self, duration) -> None:
+        deque(starmap(self.pyboy.tick, repeat((), self.act_freq * duration)), maxlen=0)
 
-        elif action == Actions.RIGHT:
-            self.pyboy.send_input(self.valid_actions[Actions.RIGHT.value])
-            self.pyboy.send_input(self.valid_actions[Actions.SPRINT.value])
+    def run_action(self, action, duration) -> None:
+        send_input = self.pyboy.send_input
+        press, release = self.action_events[action]
+
+        for event in press:
+            send_input(event)
+
+        self.run_ticks(duration)
+
+        for event in release:
+            send_input(event)
+
+
+# Scanning helpers used by MarioExpert. They only take the per-frame sprite
+# masks, the sprite index and Mario's coordinates so Numba can compile them;
+# without Numba they run as plain NumPy. The masks only cover the region of
+# interest, whose column 0 is Mario's column.
+
+# Build the boolean sprite masks used for neighbourhood checks over the region of interest
+def _sprite_masks(roi):
+    air = roi == _AIR
+    brickblock = (roi == _BRICK) | (roi == _BLOCK)
+    obstacle = brickblock | (roi == _PIPE)
+    return air, brickblock, obstacle
+
+# Index the non-air cells once per frame, bucketed by sprite category.
+# np.nonzero yields the cells in row-major order, and so does every bucket.
+def _sprite_index(ga):
+    xs, ys = np.nonzero(ga)
+    vals = ga[xs, ys]
+    mario = vals == _MARIO
+    enemy = vals >= _GOOMBA
+    solid = (vals >= _BLOCK) & (vals <= _PIPE)
+    return ((xs[mario], ys[mario]),
+            (xs[enemy], ys[enemy], vals[enemy]),
+            (xs[solid], ys[solid]))
+
+# Get coordinates of bottom right corner of Mario sprite and whether there is air beneath him
+@njit(cache=True, boundscheck=False)
+def _mario_pos(ga, mario_xs, mario_ys):
+    mx, my = 0, 0
+    if mario_xs.size:
+        mx, my = int(mario_xs[0]) + 1, int(mario_ys[0]) + 1
+    # Clamp to the grid, the cell below Mario is off the bottom when he falls out of bounds
+    below = ga[min(mx + 1, ga.shape[0] - 1), min(my, ga.shape[1] - 1)]
+    return mx, my, below == _AIR
+
+# Determine the position and identity of the nearest enemy in front of Mario
+@njit(cache=True, boundscheck=False)
+def _enemy_info(enemy_xs, enemy_ys, enemy_vals, mx, my):
+    ahead = (enemy_xs >= 1) & (enemy_xs <= mx) & (enemy_ys >= my)
+    if ahead.any():
+        xs, ys, vals = enemy_xs[ahead], enemy_ys[ahead], enemy_vals[ahead]
+        # The nearest row wins; being row-major, its first entry is the nearest column
+        i = np.argmax(xs == xs.max())
+        return (mx - int(xs[i]), int(ys[i]) - my, int(vals[i]))
+    return (100, 100, 100)
+
+# Determine the position of obstacles blocking Mario
+@njit(cache=True, boundscheck=False)
+def _obstacle_info(obstacle, air, mx):
+    rows = air.shape[0]
+    for y in range(6):
+        if obstacle[mx, y]:
+            x = mx
+            while x > -rows and not air[x, y]:
+                x -= 1
+            return y, mx - x + 1
+    return 100, 100
+
+# Check if there is a platform above Mario
+@njit(cache=True, boundscheck=False)
+def _platform_above(brickblock, air, mx):
+    end = min(7, air.shape[1])
+    if mx < 2 or end < 2:
+        return 100, 100
+    # The cell above row 0 wraps around to the bottom row
+    air_above = np.empty((mx - 1, end - 1), dtype=np.bool_)
+    air_above[0] = air[-1, 1:end]
+    air_above[1:] = air[:mx - 2, 1:end]
+    mask = brickblock[:mx - 1, 1:end] & air_above & air[:mx - 1, :end - 1]
+    # Columns are scanned before rows, so flatten the transposed mask
+    flat = mask.T.ravel()
+    i = np.argmax(flat)
+    if flat[i]:
+        y, x = divmod(int(i), mx - 1)
+        return mx - x, y + 1
+    return 100, 100
+
+# Determine the size and positions of pits in front of Mario
+@njit(cache=True, boundscheck=False)
+def _pit_info(air, solid_xs, solid_ys, mx, my):
+    # Pits beyond the region of interest are too far away for any rule to act on
+    pit_mask = air[mx + 1] & air[15]
+    if pit_mask.any():
+        yoffset = int(np.argmax(pit_mask))
+        y = my + yoffset
+        # Any later pit only sees a subset of these columns, so the first pit decides
+        land = solid_ys >= y
+        if land.any():
+            i = np.argmax(land)
+            return yoffset, mx - int(solid_xs[i]), int(solid_ys[i]) - my
+    return 100, 100, 100
+
+# Compile the helpers up front so the first frame doesn't pay for the JIT
+def _warm_up():
+    ga = np.zeros(_GAME_AREA_SHAPE, dtype=_GAME_AREA_DTYPE)
+    mario, enemies, solids = _sprite_index(ga)
+    mx, my, _ = _mario_pos(ga, *mario)
+    air, brickblock, obstacle = _sprite_masks(ga[:, my:my + _ROI_WIDTH])
+    _enemy_info(*enemies, mx, my)
+    _obstacle_info(obstacle, air, mx)
+    _platform_above(brickblock, air, mx)
+    _pit_info(air, *solids, mx, my)
+
+
+class FrameInfo:
+    """Results of the game area scans that choose_action decides on.
+
+    Each scan runs the first time a rule asks for it, so rules after the one
+    that fires never pay for theirs.
+    """
 
-            for _ in range(self.act_freq * duration):
-                self.pyboy.tick()
+    def __init__(self, expert):
+        self.expert = expert
+        # Found together with Mario's position, so there is nothing to defer
+        self.is_airborne = expert.is_airborne
 
-            self.pyboy.send_input(self.release_button[Actions.SPRINT.value])
-            self.pyboy.send_input(self.release_button[Actions.RIGHT.value])
+    @cached_property
+    def enemy_info(self):
+        return self.expert.get_enemy_info()
 
-        else:
-            self.pyboy.send_input(self.valid_actions[action.value])
+    @cached_property
+    def pit_info(self):
+        return self.expert.get_pit_info()
 
-            for _ in range(self.act_freq * duration):
-                self.pyboy.tick()
+    @cached_property
+    def obstacle_info(self):
+        return self.expert.get_obstacle_info()
 
-            self.pyboy.send_input(self.release_button[action.value])
+    @cached_property
+    def platform(self):
+        return self.expert.get_platform_above()
 
 
 class MarioExpert:
@@ -136,132 +302,134 @@ class MarioExpert:
         self.video = None 
         self.prev_action = None
         self.mario_pos = None
+        self.is_airborne = False
         self.game_area = None
+        # Reused every frame so reading the game area doesn't allocate
+        self._ga_buf = np.empty(_GAME_AREA_SHAPE, dtype=_GAME_AREA_DTYPE)
+        self._air = None
+        self._brickblock = None
+        self._obstacle = None
+        self._mario_cells = None
+        self._enemies = None
+        self._solids = None
+        _warm_up()
+
+        # Ordered (condition, action) pairs checked by choose_action
+        self.rules = [
+            (self.is_obstacle_ahead, self.jump_obstacle),
+            (self.is_platform_ahead, self.jump_platform),
+            (self.is_walker_ahead, self.avoid_walker),
+            (self.is_fly_ahead, self.jump_fly),
+            (self.is_pit_ahead, self.jump_pit),
+        ]
+
+    # Index the sprites in the current game area, find Mario and mask the region in front of him
+    def scan_game_area(self):
+        self._mario_cells, self._enemies, self._solids = _sprite_index(self.game_area)
+        mx, my, self.is_airborne = self.get_mario_pos()
+        self.mario_pos = (mx, my)
+        roi = self.game_area[:, my:my + _ROI_WIDTH]
+        self._air, self._brickblock, self._obstacle = _sprite_masks(roi)
 
-    # Get coordinates of bottom right corner of Mario sprite
+    # Get coordinates of bottom right corner of Mario sprite and whether he is airborne
     def get_mario_pos(self):
-        rows, cols = self.game_area.shape
-        for x in range(rows): 
-            for y in range(cols):
-                if self.game_area[x][y] == Sprites.MARIO.value:
-                    return (x + 1, y + 1)
-        return 0, 0
-    
-    # Check if there is air beneath Mario
-    def get_is_airborne(self):
-        if self.game_area[self.mario_pos[0] + 1][self.mario_pos[1]] == Sprites.AIR.value: 
-            return True;
-        return False;
+        mx, my, is_airborne = _mario_pos(self.game_area, *self._mario_cells)
+        return mx, my, bool(is_airborne)
     
     # Determine the position and identity of the nearest enemy in front of Mario
     def get_enemy_info(self):
-        cols = self.game_area.shape[1]
-        mx, my = self.mario_pos
-        for xoffset in range(mx): 
-            x = mx - xoffset
-            for yoffset in range(cols - my):
-                y = my + yoffset
-                if self.game_area[x][y] >= Sprites.GOOMBA.value:
-                    return (mx - x, yoffset, self.game_area[x][y])
-        return (100, 100, 100)
+        return _enemy_info(*self._enemies, *self.mario_pos)
     
     # Determine the position of obstacles blocking Mario
     def get_obstacle_info(self):
-        mx, my = self.mario_pos
-        for y in range(6):
-            val = self.game_area[mx][my + y];
-            if val == Sprites.BRICK.value or val == Sprites.PIPE.value or val == Sprites.BLOCK.value:
-                x = mx
-                while self.game_area[x][my + y] != Sprites.AIR.value:
-                    x -= 1
-                return y, mx - x + 1
-        return 100, 100
+        return _obstacle_info(self._obstacle, self._air, self.mario_pos[0])
     
     # Check if there is a platform above Mario
     def get_platform_above(self):
-        mx, my = self.mario_pos
-        for y in range (6):
-            y += 1
-            for x in range(mx - 1):
-                if ((self.game_area[x][my + y] == Sprites.BRICK.value or 
-                     self.game_area[x][my + y] == Sprites.BLOCK.value) and
-                     self.game_area[x - 1][my + y] == Sprites.AIR.value and
-                     self.game_area[x][my + y - 1] == Sprites.AIR.value):
-                    return mx - x, y
-        return 100, 100
+        return _platform_above(self._brickblock, self._air, self.mario_pos[0])
     
     # Determine the size and positions of pits in front of Mario
     def get_pit_info(self):
-        rows, cols = self.game_area.shape
-        mx, my = self.mario_pos
-        for yoffset in range(cols - my):
-            y = my + yoffset
-            if self.game_area[mx + 1][y] == Sprites.AIR.value and self.game_area[15][y] == Sprites.AIR.value:
-                for a in range(rows):
-                    for boffset in range(cols - y):
-                        b = y + boffset
-                        if self.game_area[a][b] >= Sprites.BLOCK.value and self.game_area[a][b] <= Sprites.PIPE.value:
-                            return yoffset, mx - a, b - my
-        return 100, 100, 100
+        return _pit_info(self._air, *self._solids, *self.mario_pos)
     
-    # Get the distance to a point using the pythagorean theorem
-    def get_pythag_dist(self, a, b): return math.ceil(math.sqrt(a**2 + b**2))
+    # Get the distance to a point using the pythagorean theorem, rounded up
+    def get_pythag_dist(self, a, b):
+        n = a * a + b * b
+        return math.isqrt(n - 1) + 1 if n else 0
+
+    # Jump over upcoming obstacles
+    def is_obstacle_ahead(self, info):
+        return info.obstacle_info[0] < 3 and not info.is_airborne
+
+    def jump_obstacle(self, info):
+        print("Jump over obstacle of height ", info.obstacle_info[1])
+        return Actions.JUMP, info.obstacle_info[1] * 2
+
+    # Jump onto upcoming platforms
+    def is_platform_ahead(self, info):
+        platform = info.platform
+        return platform[1] < 6 and platform[0] < 6 and platform[0] != info.obstacle_info[0]
+
+    def jump_platform(self, info):
+        print("Jump onto platform at ", info.platform)
+        duration = info.platform[0] * 3
+        if (info.pit_info[0] < info.platform[1]): 
+            duration += 10
+        return Actions.JUMP, duration
+
+    # Check if Goomba or Koopa are right in front of Mario
+    def is_walker_ahead(self, info):
+        return info.enemy_info[2] < 18 and info.enemy_info[1] < 2
+
+    def avoid_walker(self, info):
+        print("Goomba/Koopa ahead")
+        # Prevent collision with enemy
+        if self.prev_action == Actions.JUMP:
+            return Actions.LEFT, 1
+        # Jump over/onto enemy
+        return Actions.JUMP, 1
+
+    # Jump over Flies
+    def is_fly_ahead(self, info):
+        return info.enemy_info[2] == 19 and info.enemy_info[1] < 4
+
+    def jump_fly(self, info):
+        print("Fly ahead")
+        return Actions.JUMP, info.enemy_info[0] + 10
+
+    # Jump over upcoming pits
+    def is_pit_ahead(self, info):
+        return info.pit_info[0] < 2 and not info.is_airborne
+
+    def jump_pit(self, info):
+        pit_info = info.pit_info
+        print("Pit is", pit_info[0], "away and other side at", pit_info[1], pit_info[2])
+        return Actions.JUMP, self.get_pythag_dist(max(4, pit_info[1]), pit_info[2])
 
     # Choosing Action
     def choose_action(self):
-        self.game_area = self.environment.game_area()
-        self.mario_pos = self.get_mario_pos()
+        np.copyto(self._ga_buf, self.environment.game_area())
+
+        # Run the whole decision in one C call when the Cython kernel is built
+        if _kernel_choose is not None:
+            action, duration, prev_action = _kernel_choose(self._ga_buf, self.prev_action or 0)
+            self.prev_action = Actions(prev_action) if prev_action else None
+            return Actions(action), duration
+
+        self.game_area = self._ga_buf
+        self.scan_game_area()
+        mx, my = self.mario_pos
 
         # Break if Mario is out of bounds (Dead or Level Complete)
-        if (self.mario_pos[0] >= 15 or self.mario_pos[1] >= 15):
+        if (mx >= 15 or my >= 15):
             return Actions.RIGHT, 1
         
-        enemy_info = self.get_enemy_info()
-        pit_info = self.get_pit_info()
-        obstacle_info = self.get_obstacle_info()
-        is_airborne = self.get_is_airborne()
-        platform = self.get_platform_above()
-
-        action = Actions.RIGHT
-        duration = 1
-
-        # Jump over upcoming obstacles
-        if obstacle_info[0] < 3 and is_airborne == False:
-            print("Jump over obstacle of height ", obstacle_info[1])
-            action = Actions.JUMP
-            duration = obstacle_info[1] * 2
-
-        # Jump onto upcoming platforms
-        elif platform[1] < 6 and platform[0] < 6 and platform[0] != obstacle_info[0]: 
-            print("Jump onto platform at ", platform)
-            action = Actions.JUMP
-            duration = platform[0] * 3
-            if (pit_info[0] < platform[1]): 
-                duration += 10
-        
-        # Check if Goomba or Koopa are right in front of Mario
-        elif enemy_info[2] < 18 and enemy_info[1] < 2:
-            print("Goomba/Koopa ahead")
-            # Prevent collision with enemy
-            if self.prev_action == Actions.JUMP:
-                action = Actions.LEFT
-                duration = 1
-            # Jump over/onto enemy
-            else: 
-                action = Actions.JUMP
-                duration = 1
-
-        # Jump over Flies
-        elif enemy_info[2] == 19 and enemy_info[1] < 4:
-            print("Fly ahead")
-            action = Actions.JUMP
-            duration = enemy_info[0] + 10
-
-        # Jump over upcoming pits
-        elif pit_info[0] < 2 and is_airborne == False:
-            print("Pit is", pit_info[0], "away and other side at", pit_info[1], pit_info[2])
-            action = Actions.JUMP
-            duration = self.get_pythag_dist(max(4, pit_info[1]), pit_info[2])
+        info = FrameInfo(self)
+
+        # The first rule whose condition holds picks the action, otherwise keep running right
+        action, duration = next(
+            (act(info) for cond, act in self.rules if cond(info)), (Actions.RIGHT, 1)
+        )
 
         # Prevent Mario from getting stuck
         if self.prev_action == action and action == Actions.JUMP:
@@ -0,0 +1,187 @@
+# cython: boundscheck=False, wraparound=False, language_level=3
+"""
+Cython port of the MarioExpert decision logic. It runs the game area scans and the action rules of
+choose_action in a single C call per frame.
+
+It is optional - when it hasn't been built MarioExpert falls back to its Python/Numba helpers.
+Build it from the scripts folder with:
+
+    python3 setup.py build_ext --inplace
+
+Keep the scans and rules in step with mario_expert.py.
+"""
+
+from libc.math cimport ceil, sqrt
+
+# Sprite ids, see Sprites in mario_expert.py
+cdef enum:
+    AIR = 0
+    MARIO = 1
+    BLOCK = 10
+    BRICK = 12
+    PIPE = 14
+    GOOMBA = 15
+
+# Columns scanned for pits from Mario's column, see _ROI_WIDTH in mario_expert.py
+cdef enum:
+    ROI_WIDTH = 8
+
+# Action ids, see Actions in mario_expert.py
+cdef enum:
+    LEFT = 1
+    RIGHT = 2
+    JUMP = 4
+
+
+# Check if there is air beneath Mario, clamped to the grid for when he falls out of bounds
+cdef inline bint air_below(signed char[:, ::1] ga, int mx, int my):
+    return ga[min(mx + 1, ga.shape[0] - 1), min(my, ga.shape[1] - 1)] == AIR
+
+
+# Get coordinates of bottom right corner of Mario sprite and whether there is air beneath him.
+# The flag is returned as an int, Cython would otherwise share the ctuple type with (int, int, int).
+cdef (int, int, int) mario_pos(signed char[:, ::1] ga):
+    cdef int x, y
+    for x in range(ga.shape[0]):
+        for y in range(ga.shape[1]):
+            if ga[x, y] == MARIO:
+                return x + 1, y + 1, air_below(ga, x + 1, y + 1)
+    return 0, 0, air_below(ga, 0, 0)
+
+
+# Determine the position and identity of the nearest enemy in front of Mario
+cdef (int, int, int) enemy_info(signed char[:, ::1] ga, int mx, int my):
+    cdef int xoffset, x, y
+    for xoffset in range(mx):
+        x = mx - xoffset
+        for y in range(my, ga.shape[1]):
+            if ga[x, y] >= GOOMBA:
+                return xoffset, y - my, ga[x, y]
+    return 100, 100, 100
+
+
+# Determine the position of obstacles blocking Mario
+cdef (int, int) obstacle_info(signed char[:, ::1] ga, int mx, int my):
+    cdef int rows = ga.shape[0]
+    cdef int x, y, val
+    for y in range(6):
+        val = ga[mx, my + y]
+        if val == BRICK or val == PIPE or val == BLOCK:
+            x = mx
+            # Negative rows wrap around to the bottom of the game area
+            while x > -rows and ga[x if x >= 0 else x + rows, my + y] != AIR:
+                x -= 1
+            return y, mx - x + 1
+    return 100, 100
+
+
+# Check if there is a platform above Mario
+cdef (int, int) platform_above(signed char[:, ::1] ga, int mx, int my):
+    cdef int rows = ga.shape[0]
+    cdef int x, y, val
+    for y in range(1, min(7, ga.shape[1] - my)):
+        for x in range(mx - 1):
+            val = ga[x, my + y]
+            # The cell above row 0 wraps around to the bottom row
+            if ((val == BRICK or val == BLOCK) and
+                 ga[x - 1 if x > 0 else rows - 1, my + y] == AIR and
+                 ga[x, my + y - 1] == AIR):
+                return mx - x, y
+    return 100, 100
+
+
+# Determine the size and positions of pits in front of Mario
+cdef (int, int, int) pit_info(signed char[:, ::1] ga, int mx, int my):
+    cdef int cols = ga.shape[1]
+    cdef int y, a, b, val
+    # Pits beyond the region of interest are too far away for any rule to act on
+    for y in range(my, min(my + ROI_WIDTH, cols)):
+        if ga[mx + 1, y] == AIR and ga[15, y] == AIR:
+            for a in range(ga.shape[0]):
+                for b in range(y, cols):
+                    val = ga[a, b]
+                    if val >= BLOCK and val <= PIPE:
+                        return y - my, mx - a, b - my
+            # Any later pit only sees a subset of these columns, so the first pit decides
+            break
+    return 100, 100, 100
+
+
+# Get the distance to a point using the pythagorean theorem, rounded up
+cdef int pythag_dist(int a, int b):
+    return <int>ceil(sqrt(a * a + b * b))
+
+
+cpdef (int, int, int) choose(signed char[:, ::1] ga, int prev_action):
+    """
+    Choose the next action for the given game area.
+
+    Args:
+        ga (int8 array): The contiguous game area for this frame.
+        prev_action (int): The previously chosen action, 0 if there is none.
+
+    Returns:
+        The action, its duration and the action to remember as the previous one.
+    """
+    cdef int mx, my, action, duration
+    cdef bint is_airborne
+    cdef (int, int) obstacle, platform
+    cdef (int, int, int) enemy, pit
+
+    mx, my, is_airborne = mario_pos(ga)
+
+    # Break if Mario is out of bounds (Dead or Level Complete)
+    if mx >= 15 or my >= 15:
+        return RIGHT, 1, prev_action
+
+    obstacle = obstacle_info(ga, mx, my)
+    platform = platform_above(ga, mx, my)
+    enemy = enemy_info(ga, mx, my)
+    pit = pit_info(ga, mx, my)
+
+    action = RIGHT
+    duration = 1
+
+    # Jump over upcoming obstacles
+    if obstacle[0] < 3 and not is_airborne:
+        print("Jump over obstacle of height ", obstacle[1])
+        action = JUMP
+        duration = obstacle[1] * 2
+
+    # Jump onto upcoming platforms
+    elif platform[1] < 6 and platform[0] < 6 and platform[0] != obstacle[0]:
+        print("Jump onto platform at ", (platform[0], platform[1]))
+        action = JUMP
+        duration = platform[0] * 3
+        if pit[0] < platform[1]:
+            duration += 10
+
+    # Check if Goomba or Koopa are right in front of Mario
+    elif enemy[2] < 18 and enemy[1] < 2:
+        print("Goomba/Koopa ahead")
+        # Prevent collision with enemy
+        if prev_action == JUMP:
+            action = LEFT
+        # Jump over/onto enemy
+        else:
+            action = JUMP
+
+    # Jump over Flies
+    elif enemy[2] == 19 and enemy[1] < 4:
+        print("Fly ahead")
+        action = JUMP
+        duration = enemy[0] + 10
+
+    # Jump over upcoming pits
+    elif pit[0] < 2 and not is_airborne:
+        print("Pit is", pit[0], "away and other side at", pit[1], pit[2])
+        action = JUMP
+        duration = pythag_dist(max(4, pit[1]), pit[2])
+
+    # Prevent Mario from getting stuck
+    if prev_action == action and action == JUMP:
+        print('Prevented jump loop')
+        action = RIGHT
+        duration = 1
+
+    return action, duration, action
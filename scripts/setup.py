@@ -0,0 +1,12 @@
+"""
+Builds the optional Cython decision kernel (mario_kernel.pyx) used by MarioExpert.
+
+Run from the scripts folder:
+
+    python3 setup.py build_ext --inplace
+"""
+
+from Cython.Build import cythonize
+from setuptools import setup
+
+setup(ext_modules=cythonize("mario_kernel.pyx"))